@@ -5,76 +5,213 @@ from __future__ import annotations
 import itertools
 import logging
 import os
+import socket
+import threading
 import time
 import typing
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from fnmatch import fnmatchcase
-from typing import Union
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Union
 
 import sqlalchemy
 import sqlalchemy.exc
 from sqlalchemy import MetaData, text
-from sqlalchemy.engine import Engine
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import QueuePool
 
 from joker.relational.utils import _stringify_statement
 
 _logger = logging.getLogger(__name__)
 
+# language=SQL
+_STMT_DATABASE_NAMES = text('SELECT datname FROM pg_database;')
+
+
+_REFRESH_PREFIXES = {
+    True: 'REFRESH MATERIALIZED VIEW CONCURRENTLY ',
+    False: 'REFRESH MATERIALIZED VIEW ',
+}
+
+
+@lru_cache(maxsize=256)
+def _refresh_mview_stmt(mview: str, concurrently: bool):
+    # identifiers cannot be bound; cache the text() per (mview, concurrently)
+    return text(_REFRESH_PREFIXES[concurrently] + mview + ';')
+
+
+_register_at_fork = getattr(os, 'register_at_fork', None)
+_forkable_interfaces = weakref.WeakSet()
+
+
+def _dispose_engines_after_fork():
+    # http://docs.sqlalchemy.org/en/latest/core/pooling.html
+    # section "Using Connection Pools with Multiprocessing"
+    # close=False: the child must not close connections it shares with
+    # the parent, or the server drops the parent's connections
+    for itf in list(_forkable_interfaces):
+        itf.engine.dispose(close=False)
+        itf._conn_tls = threading.local()
+
+
+if _register_at_fork is not None:
+    _register_at_fork(after_in_child=_dispose_engines_after_fork)
+
+
+def _pool_capacity(pool) -> Optional[int]:
+    # QueuePool keeps max_overflow private; None means no limit
+    if not isinstance(pool, QueuePool):
+        return None
+    if pool.size() <= 0 or pool._max_overflow < 0:
+        return None
+    return pool.size() + pool._max_overflow
+
+
+def _exponential_backoff(base: float = 0.1, cap: float = 8):
+    sec = base
+    while True:
+        yield sec
+        sec = min(cap, sec * 2)
+
+
+def _mview_edges(mviews, deps: dict) -> frozenset:
+    # dependencies on views not being refreshed are ignored
+    names = set(mviews)
+    return frozenset(
+        (v, d) for v, ds in deps.items() if v in names
+        for d in ds if d in names
+    )
+
+
+@lru_cache(maxsize=64)
+def _plan_mview_waves(mviews: tuple, edges: frozenset) -> tuple:
+    # graphlib is new in python 3.9
+    from graphlib import TopologicalSorter
+    # each wave contains views whose dependencies are all in earlier waves
+    sorter = TopologicalSorter({v: () for v in mviews})
+    for v, dep in edges:
+        sorter.add(v, dep)
+    sorter.prepare()
+    waves = []
+    while sorter.is_active():
+        wave = sorter.get_ready()
+        waves.append(wave)
+        sorter.done(*wave)
+    return tuple(waves)
+
 
 # noinspection SqlNoDataSourceInspection
 class SQLInterface:
+    _logger = _logger
     _loglevel = logging.INFO
+    _pool_defaults = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
 
     def __init__(self, engine: Engine, metadata: MetaData):
         self.engine = engine
         self.metadata = metadata
-        self._pid = os.getpid()
+        self._conn_tls = threading.local()
+        if _register_at_fork is None:
+            self._pid = os.getpid()
+        else:
+            _forkable_interfaces.add(self)
 
     @classmethod
     def from_config(cls, options: dict, metadata: MetaData = None):
+        options = dict(options)
+        if 'poolclass' not in options and 'pool' not in options:
+            url = make_url(options['url'])
+            poolclass = url.get_dialect().get_pool_class(url)
+            # e.g. NullPool for file-based sqlite rejects pool_size
+            if issubclass(poolclass, QueuePool):
+                for key, val in cls._pool_defaults.items():
+                    options.setdefault(key, val)
         engine = sqlalchemy.create_engine(**options)
         return cls(engine, metadata or MetaData())
 
+    def _log_statement(self, statement):
+        if self._logger.isEnabledFor(self._loglevel):
+            self._logger.log(self._loglevel, _stringify_statement(statement))
+
     def execute(self, statement, *multiparams, **params):
-        if _logger.isEnabledFor(self._loglevel):
-            _logger.log(self._loglevel, _stringify_statement(statement))
-        with self.engine.begin() as conn:
+        self._log_statement(statement)
+        conn = getattr(self._conn_tls, 'conn', None)
+        if conn is None:
+            with self.engine.begin() as conn:
+                return conn.execute(statement, *multiparams, **params)
+        if conn.in_transaction():
+            return conn.execute(statement, *multiparams, **params)
+        with conn.begin():
             return conn.execute(statement, *multiparams, **params)
 
-    def __call__(self, statement):
-        return self.execute(statement)
+    @contextmanager
+    def session(self):
+        """
+        Reuse one connection for all execute() calls made in the current
+        thread inside the with-block. Each statement is still committed
+        on its own, unless a transaction is begun on the yielded connection.
+        """
+        conn = getattr(self._conn_tls, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        with self.engine.connect() as conn:
+            self._conn_tls.conn = conn
+            try:
+                yield conn
+            finally:
+                self._conn_tls.conn = None
+
+    def __call__(self, statement, *multiparams, **params):
+        return self.execute(statement, *multiparams, **params)
 
     def execute_script(self, path: str):
-        # https://docs.sqlalchemy.org/en/12/core/connections.html#sqlalchemy.engine.Engine.raw_connection
-        # https://www.psycopg.org/docs/connection.html
-        # https://www.psycopg.org/docs/cursor.html
-        connection = self.engine.raw_connection()
+        # https://docs.sqlalchemy.org/en/14/core/connections.html#sqlalchemy.engine.Connection.exec_driver_sql
+        # no_parameters: run cursor.execute(script) without a parameter
+        # collection, so that '%' and ':name' in the script are left alone
         _logger.debug('execute sql script: %s', path)
-        try:
-            with connection.cursor() as cursor:
-                return cursor.execute(open(path).read())
-        except Exception:
-            connection.rollback()
-        finally:
-            connection.commit()
-            connection.close()
+        script = Path(path).read_text(encoding='utf-8')
+        with self.engine.begin() as conn:
+            conn = conn.execution_options(no_parameters=True)
+            conn.exec_driver_sql(script)
 
     def just_after_fork(self):
-        # http://docs.sqlalchemy.org/en/latest/core/pooling.html
-        # section "Using Connection Pools with Multiprocessing"
+        # engines are disposed by _dispose_engines_after_fork in the child
+        # process, if the platform supports os.register_at_fork
+        if _register_at_fork is not None:
+            return
         if self._pid != os.getpid():
             self.engine.dispose()
             self._pid = os.getpid()
 
-    def create_tables(self, fullnames: list = None, ignore='*_view'):
+    def create_tables(
+            self, fullnames: list = None, ignore='*_view', checkfirst=True):
+        """
+        Args:
+            fullnames: keys of metadata.tables; all tables if None
+            ignore: a glob pattern of table names to skip, used with fullnames
+            checkfirst: set False to skip per-table existence checks,
+                e.g. when bootstrapping an empty database
+        Returns:
+            None
+        """
         if _logger.isEnabledFor(logging.INFO):
             names = self.metadata.tables if fullnames is None else fullnames
             _logger.info('creating tables: %s', ' '.join(names))
-        if fullnames is None:
-            return self.metadata.create_all(self.engine)
-        tables = [self.metadata.tables[name] for name in fullnames]
-        if ignore:
+        tables = None
+        if fullnames is not None:
+            tables = [self.metadata.tables[name] for name in fullnames]
+        if tables and ignore:
             tables = [t for t in tables if not fnmatchcase(t.name, ignore)]
-        return self.metadata.create_all(self.engine, tables=tables)
+        return self.metadata.create_all(
+            self.engine, tables=tables, checkfirst=checkfirst)
 
     def get_sibling_engine(self, database: str, **kwargs) -> Engine:
         url = self.engine.url.set(database=database)
@@ -88,82 +225,241 @@ class SQLInterface:
 
 class PostgreSQLInterface(SQLInterface):
     _preset_schemas = {'public'}
+    _schema_cache = None
 
     def get_schemas(self) -> set:
-        schemas = self._preset_schemas.copy()
-        for tbl in self.metadata.tables.values():
-            if tbl.schema is None:
-                continue
-            schemas.add(tbl.schema)
-        return schemas
+        # tables are rarely removed from metadata at runtime,
+        # so the number of tables is taken as a staleness signal;
+        # the metadata itself is kept, as its id() could be reused
+        metadata = self.metadata
+        size = len(metadata.tables)
+        if self._schema_cache:
+            cached_metadata, cached_size, schemas = self._schema_cache
+            if cached_metadata is metadata and cached_size == size:
+                return set(schemas)
+        schemas = frozenset({
+            *self._preset_schemas,
+            *(t.schema for t in metadata.tables.values()
+              if t.schema is not None),
+        })
+        self._schema_cache = metadata, size, schemas
+        return set(schemas)
 
     def create_schemas(self, schemas: list = None):
         if schemas is None:
             schemas = self.get_schemas()
-        for schema in schemas:
-            _logger.info('creating schema: %s', schema)
-            stmt = text(f'CREATE SCHEMA IF NOT EXISTS {schema};')
-            self.execute(stmt)
+        if not schemas:
+            return
+        # one round-trip, in one transaction
+        sql = '\n'.join(f'CREATE SCHEMA IF NOT EXISTS {s};' for s in schemas)
+        self.execute(text(sql))
+        if _logger.isEnabledFor(logging.INFO):
+            _logger.info('schemas created: %s', ' '.join(schemas))
 
-    def refresh_materialized_views(self, mviews: list, concurrently=True):
+    def _refresh_materialized_view(self, mview: str, concurrently=True):
+        self.execute(_refresh_mview_stmt(mview, bool(concurrently)))
+        _logger.info('mview refreshed: %s', mview)
+
+    def refresh_materialized_views(
+            self, mviews: list, concurrently=True, max_parallel: int = 1):
+        """
+        Args:
+            mviews: names of materialized views
+            concurrently: refresh without locking out concurrent selects
+            max_parallel: max number of views refreshed at the same time,
+                each on its own pooled connection; capped at
+                pool_size + max_overflow of the engine; keep it 1 if
+                views depend on each other
+        Returns:
+            mviews
+        """
         # https://www.postgresql.org/docs/current/sql-refreshmaterializedview.html
-        for v in mviews:
-            if concurrently:
-                self.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {v};')
-            else:
-                self.execute(f'REFRESH MATERIALIZED VIEW {v};')
-            _logger.info('mview refreshed: %s', v)
+        if max_parallel <= 1:
+            with self.session():
+                for v in mviews:
+                    self._refresh_materialized_view(v, concurrently)
+            return mviews
+        self._refresh_materialized_views_parallel(
+            mviews, concurrently, max_parallel)
         return mviews
 
+    def _refresh_materialized_views_parallel(
+            self, mviews, concurrently: bool, max_parallel: int):
+        # workers beyond the pool capacity would time out on checkout
+        capacity = _pool_capacity(self.engine.pool)
+        if capacity is not None and capacity < max_parallel:
+            _logger.info(
+                'max_parallel=%s capped to pool capacity=%s',
+                max_parallel, capacity,
+            )
+            max_parallel = capacity
+        refresh = self._refresh_materialized_view
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            futures = [
+                executor.submit(refresh, v, concurrently) for v in mviews
+            ]
+            for fut in futures:
+                fut.result()
+
+    def refresh_materialized_views_planned(
+            self, mviews: list, deps: dict, concurrently=True,
+            max_parallel: int = 4, checkpoint=False):
+        """
+        Args:
+            mviews: names of materialized views
+            deps: {mview: [mviews it depends on]};
+                dependencies not listed in mviews are ignored
+            concurrently: refresh without locking out concurrent selects
+            max_parallel: max number of views refreshed at the same time
+            checkpoint: issue a CHECKPOINT between waves
+        Returns:
+            a tuple of waves, i.e. tuples of views refreshed together
+        Raises:
+            graphlib.CycleError: if deps contain a cycle
+        Requires python 3.9+ (graphlib).
+        """
+        mviews = tuple(mviews)
+        waves = _plan_mview_waves(mviews, _mview_edges(mviews, deps))
+        for i, wave in enumerate(waves):
+            if i and checkpoint:
+                # language=SQL
+                self.execute(text('CHECKPOINT;'))
+            if len(wave) == 1 or max_parallel <= 1:
+                for v in wave:
+                    self._refresh_materialized_view(v, concurrently)
+            else:
+                self._refresh_materialized_views_parallel(
+                    wave, concurrently, min(max_parallel, len(wave)))
+        return waves
+
+    def refresh_materialized_views_incremental(self, targets: list, since):
+        """
+        Merge only new rows into summary relations, and run a fallback
+        statement where the merge fails.
+
+        PostgreSQL does not allow INSERT/UPDATE on a materialized view,
+        so merge statements target plain tables maintained as
+        materializations, e.g.
+        INSERT INTO daily_sales SELECT ... FROM sales WHERE ts > :since
+
+        Inside session(), a merge failing in a transaction begun by the
+        caller is rolled back to a savepoint, leaving the transaction usable.
+
+        Args:
+            targets: a list of (name, merge, fallback) triples;
+                merge is a str or text() with a `:since` bind parameter;
+                fallback is a str or text() rebuilding the target fully,
+                or None to re-raise the error of the merge
+            since: value bound to `:since`
+        Returns:
+            names for which the fallback was run
+        """
+        fallbacks = []
+        for name, merge, fallback in targets:
+            if isinstance(merge, str):
+                merge = text(merge)
+            try:
+                self._execute_in_savepoint(merge, {'since': since})
+                _logger.info('summary merged: %s', name)
+            except sqlalchemy.exc.DBAPIError as exc:
+                if fallback is None:
+                    raise
+                _logger.warning(
+                    'summary merge failed, rebuilding fully: %s -- %s',
+                    name, exc.args[0],
+                )
+                if isinstance(fallback, str):
+                    fallback = text(fallback)
+                self.execute(fallback)
+                fallbacks.append(name)
+        return fallbacks
+
+    def _execute_in_savepoint(self, statement, *multiparams, **params):
+        conn = getattr(self._conn_tls, 'conn', None)
+        if conn is None or not conn.in_transaction():
+            # execute() runs the statement in a transaction of its own
+            return self.execute(statement, *multiparams, **params)
+        with conn.begin_nested():
+            return self.execute(statement, *multiparams, **params)
+
 
 # noinspection SqlNoDataSourceInspection
 class PostgreSQLAdminInterface(PostgreSQLInterface):
+    # seconds during which the list of database names is reused
+    _catalog_ttl = 5
+    _database_names = None
+
     def wait_until_server_ready(
             self, timeout: int = 30,
-            interval: Union[int, float, typing.Iterable] = 3):
+            interval: Optional[Union[int, float, typing.Iterable]] = None):
         """
         Args:
             timeout: in second
-            interval: a number or an iterable of numbers (e.g. [1, 2, 4, ...])
+            interval: a number or an iterable of numbers (e.g. [1, 2, 4, ...]);
+                exponential backoff from 0.1 up to 8 seconds if None
         Returns:
             None
         """
-        start = time.time()
-        if isinstance(interval, (int, float)):
+        deadline = time.monotonic() + timeout
+        if interval is None:
+            interval = _exponential_backoff()
+        elif isinstance(interval, (int, float)):
             interval = itertools.repeat(interval)
         else:
             interval = itertools.cycle(interval)
+        url = self.engine.url
+        # a host starting with '/' is a unix socket directory
+        tcp = bool(url.host) and not url.host.startswith('/')
         for sec in interval:
             try:
+                # cheap probe before a full connection and SQL round-trip
+                if tcp:
+                    address = url.host, url.port or 5432
+                    socket.create_connection(address, timeout=.5).close()
                 # language=SQL
                 self.execute('SELECT 1;').scalar()
                 _logger.info('database server is ready now!')
                 return
+            except OSError as exc:
+                _logger.info(
+                    'database server is not ready: %s -- %s', url, exc,
+                )
             except sqlalchemy.exc.OperationalError as exc:
                 _logger.info(
                     'database server is not ready: %s -- %s',
-                    self.engine.url, exc.args[0],
+                    url, exc.args[0],
                 )
-            remaining = timeout + start - time.time()
-            if remaining < 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 break
             time.sleep(min(remaining, sec))
-        _logger.info('failed to connect to %s', self.engine.url)
+        _logger.info('failed to connect to %s', url)
 
     def exists(self, database: str):
         # https://www.postgresql.org/docs/current/catalog-pg-database.html
         # alternative: from sqlalchemy_utils.functions import database_exists
-        sql = f"SELECT 1 FROM pg_database WHERE datname='{database}';"
         try:
-            return bool(self.execute(sql).scalar())
+            return database in self._get_database_names()
         except sqlalchemy.exc.OperationalError:
             return False
 
+    def _get_database_names(self) -> frozenset:
+        now = time.monotonic()
+        if self._database_names and self._database_names[0] > now:
+            return self._database_names[1]
+        names = frozenset(r[0] for r in self.execute(_STMT_DATABASE_NAMES))
+        self._database_names = now + self._catalog_ttl, names
+        return names
+
     def create_database(self, name: str):
         if self.exists(name):
             _logger.info('database exists already, creation skipped')
             return
-        with self.engine.connect():
+        # CREATE DATABASE cannot run inside a transaction block
+        with self.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level='AUTOCOMMIT')
             # language=SQL
-            sql = f'CREATE DATABASE {name};'
-            self.execute(sql)
+            stmt = text(f'CREATE DATABASE {name};')
+            self._log_statement(stmt)
+            conn.execute(stmt)
+        self._database_names = None
@@ -12,20 +12,14 @@ from sqlalchemy import MetaData, Table, select, insert
 from sqlalchemy.dialects import postgresql
 
 from joker.relational import PostgreSQLInterface, PostgreSQLAdminInterface
-from joker.relational.utils import _stringify_statement
 
 _logger = logging.getLogger(__name__)
 
 
 class ExtendedPostgreSQLInterface(PostgreSQLInterface):
+    _logger = _logger
     _loglevel = logging.DEBUG
 
-    def execute(self, statement, *multiparams, **params):
-        if _logger.isEnabledFor(self._loglevel):
-            _logger.log(self._loglevel, _stringify_statement(statement))
-        with self.engine.begin() as conn:
-            return conn.execute(statement, *multiparams, **params)
-
     @cached_property
     def admin(self) -> PostgreSQLAdminInterface:
         # at least for postgresql, you have to be on
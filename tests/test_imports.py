@@ -2,6 +2,7 @@
 # coding: utf-8
 
 import importlib
+from concurrent.futures import ThreadPoolExecutor
 
 import joker.meta
 # noinspection PyPackageRequirements
@@ -27,10 +28,14 @@ def _check_prefix(path):
 
 def test_module_imports():
     pdir = JokerInterface.under_project_dir()
-    for dotpath in find_all_plain_modules(pdir):
-        if _check_prefix(dotpath):
+    dotpaths = [p for p in find_all_plain_modules(pdir) if _check_prefix(p)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = []
+        for dotpath in dotpaths:
             print('importing', dotpath)
-            importlib.import_module(dotpath)
+            futures.append(executor.submit(importlib.import_module, dotpath))
+        for fut in futures:
+            fut.result()
 
 
 if __name__ == '__main__':
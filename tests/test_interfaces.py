@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import socket
+import threading
+import time
+import types
+
+import pytest
+import sqlalchemy
+import sqlalchemy.exc
+from sqlalchemy import text
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.pool import QueuePool
+
+from joker.relational import interfaces
+from joker.relational.interfaces import (
+    PostgreSQLAdminInterface, PostgreSQLInterface, SQLInterface,
+    _dispose_engines_after_fork, _mview_edges, _plan_mview_waves,
+    _pool_capacity,
+)
+
+
+def _plan(mviews, deps):
+    mviews = tuple(mviews)
+    waves = _plan_mview_waves(mviews, _mview_edges(mviews, deps))
+    return [set(w) for w in waves]
+
+
+def test_plan_mview_waves():
+    pytest.importorskip('graphlib')
+    deps = {'c': ['a'], 'd': ['b', 'c']}
+    assert _plan('abcd', deps) == [{'a', 'b'}, {'c'}, {'d'}]
+    assert _plan('abcd', {}) == [{'a', 'b', 'c', 'd'}]
+
+
+def test_plan_mview_waves_ignores_external_deps():
+    pytest.importorskip('graphlib')
+    deps = {'b': ['a', 'x'], 'y': ['a']}
+    assert _mview_edges('ab', deps) == frozenset({('b', 'a')})
+    assert _plan('ab', deps) == [{'a'}, {'b'}]
+
+
+def test_plan_mview_waves_cycle():
+    graphlib = pytest.importorskip('graphlib')
+    with pytest.raises(graphlib.CycleError):
+        _plan('ab', {'a': ['b'], 'b': ['a']})
+
+
+def test_session_reuses_connection_and_commits_per_statement(tmp_path):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path}/t.db')
+    checkouts = []
+    sqlalchemy.event.listen(
+        engine, 'checkout', lambda *args: checkouts.append(args))
+    itf = SQLInterface(engine, sqlalchemy.MetaData())
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        with itf.session():
+            itf.execute(text('CREATE TABLE t (x INTEGER);'))
+            itf.execute(text('INSERT INTO t VALUES (1);'))
+            itf.execute(text('INSERT INTO no_such_table VALUES (2);'))
+    assert len(checkouts) == 1
+    # the insert before the failure was committed on its own
+    with itf.session():
+        assert itf.execute(text('SELECT count(*) FROM t;')).scalar() == 1
+
+
+class _FakeEngine:
+    def __init__(self):
+        self.dispose_calls = []
+
+    def dispose(self, **kwargs):
+        self.dispose_calls.append(kwargs)
+
+
+@pytest.mark.skipif(
+    not hasattr(os, 'register_at_fork'), reason='requires os.register_at_fork')
+def test_dispose_engines_after_fork_keeps_parent_connections():
+    engine = _FakeEngine()
+    itf = SQLInterface(engine, sqlalchemy.MetaData())
+    _dispose_engines_after_fork()
+    assert engine.dispose_calls == [{'close': False}]
+    assert getattr(itf._conn_tls, 'conn', None) is None
+
+
+def test_just_after_fork_without_register_at_fork(monkeypatch):
+    monkeypatch.setattr(interfaces, '_register_at_fork', None)
+    engine = _FakeEngine()
+    itf = SQLInterface(engine, sqlalchemy.MetaData())
+    itf.just_after_fork()
+    assert engine.dispose_calls == []
+    # pretend the interface was created in the parent process
+    itf._pid = os.getpid() + 1
+    itf.just_after_fork()
+    assert engine.dispose_calls == [{}]
+    assert itf._pid == os.getpid()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork')
+def test_parent_connection_survives_fork(tmp_path):
+    # set JOKER_RELATIONAL_TEST_URL to run against e.g. postgresql
+    url = os.environ.get(
+        'JOKER_RELATIONAL_TEST_URL', f'sqlite:///{tmp_path}/t.db')
+    engine = sqlalchemy.create_engine(url, poolclass=QueuePool, pool_size=1)
+    itf = SQLInterface(engine, sqlalchemy.MetaData())
+    stmt = text('SELECT 1;')
+    with itf.session():
+        assert itf.execute(stmt).scalar() == 1
+    pool = engine.pool
+    pid = os.fork()
+    if pid == 0:
+        # the fork hook has replaced the pool in the child
+        os._exit(0 if engine.pool is not pool else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert engine.pool is pool
+    with itf.session():
+        assert itf.execute(stmt).scalar() == 1
+    engine.dispose()
+
+
+def test_refresh_materialized_views_incremental(tmp_path):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path}/t.db')
+    itf = PostgreSQLInterface(engine, sqlalchemy.MetaData())
+    with itf.session():
+        itf.execute(text('CREATE TABLE src (x INTEGER);'))
+        itf.execute(text('INSERT INTO src VALUES (1), (2), (3);'))
+        itf.execute(text('CREATE TABLE s1 (x INTEGER);'))
+        itf.execute(text('CREATE TABLE s2 (x INTEGER);'))
+    targets = [
+        ('s1', 'INSERT INTO s1 SELECT x FROM src WHERE x > :since;',
+         'INSERT INTO s1 SELECT x FROM src;'),
+        ('s2', 'INSERT INTO s2 SELECT no_such_column FROM src;',
+         'INSERT INTO s2 SELECT x FROM src;'),
+    ]
+    assert itf.refresh_materialized_views_incremental(targets, 1) == ['s2']
+    with itf.session():
+        assert itf.execute(text('SELECT count(*) FROM s1;')).scalar() == 2
+        assert itf.execute(text('SELECT count(*) FROM s2;')).scalar() == 3
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        itf.refresh_materialized_views_incremental(
+            [('s2', targets[1][1], None)], 1)
+
+
+def test_refresh_incremental_keeps_caller_transaction(tmp_path):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path}/t.db')
+
+    # let SQLAlchemy emit BEGIN itself, so that SAVEPOINT works on pysqlite
+    # https://docs.sqlalchemy.org/en/14/dialects/sqlite.html#pysqlite-serializable
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, _):
+        dbapi_connection.isolation_level = None
+
+    @sqlalchemy.event.listens_for(engine, 'begin')
+    def _on_begin(conn):
+        conn.exec_driver_sql('BEGIN')
+
+    itf = PostgreSQLInterface(engine, sqlalchemy.MetaData())
+    targets = [
+        ('s', 'INSERT INTO s SELECT no_such_column FROM s;',
+         'INSERT INTO s VALUES (2);'),
+    ]
+    with itf.session() as conn:
+        itf.execute(text('CREATE TABLE s (x INTEGER);'))
+        with conn.begin():
+            itf.execute(text('INSERT INTO s VALUES (1);'))
+            itf.refresh_materialized_views_incremental(targets, 0)
+        rows = itf.execute(text('SELECT x FROM s ORDER BY x;')).fetchall()
+    assert [r[0] for r in rows] == [1, 2]
+
+
+def test_get_schemas_cache():
+    engine = sqlalchemy.create_engine('sqlite://')
+    itf = PostgreSQLInterface(engine, sqlalchemy.MetaData())
+    assert itf.get_schemas() == {'public'}
+    sqlalchemy.Table('t1', itf.metadata, schema='s1')
+    assert itf.get_schemas() == {'public', 's1'}
+    # same number of tables, but a different metadata
+    itf.metadata = sqlalchemy.MetaData()
+    sqlalchemy.Table('t2', itf.metadata, schema='s2')
+    assert itf.get_schemas() == {'public', 's2'}
+
+
+def test_refresh_materialized_views_capped_by_pool(monkeypatch):
+    engine = sqlalchemy.create_engine(
+        'sqlite://', poolclass=QueuePool, pool_size=1, max_overflow=1)
+    assert _pool_capacity(engine.pool) == 2
+    itf = PostgreSQLInterface(engine, sqlalchemy.MetaData())
+    lock = threading.Lock()
+    running = [0]
+    peaks = []
+
+    def _refresh(mview, concurrently=True):
+        with lock:
+            running[0] += 1
+            peaks.append(running[0])
+        time.sleep(.05)
+        with lock:
+            running[0] -= 1
+
+    monkeypatch.setattr(itf, '_refresh_materialized_view', _refresh)
+    itf.refresh_materialized_views(list('abcdef'), max_parallel=8)
+    assert len(peaks) == 6
+    assert max(peaks) == 2
+
+
+def test_refresh_planned_serial(monkeypatch):
+    pytest.importorskip('graphlib')
+    engine = sqlalchemy.create_engine('sqlite://')
+    itf = PostgreSQLInterface(engine, sqlalchemy.MetaData())
+    refreshed = []
+
+    def _refresh(mview, concurrently=True):
+        refreshed.append(mview)
+
+    monkeypatch.setattr(itf, '_refresh_materialized_view', _refresh)
+    for max_parallel in (0, 1):
+        refreshed.clear()
+        itf.refresh_materialized_views_planned(
+            'abc', {'c': ['a']}, max_parallel=max_parallel)
+        assert sorted(refreshed[:2]) == ['a', 'b']
+        assert refreshed[2:] == ['c']
+
+
+class _StubResult:
+    def scalar(self):
+        return 1
+
+
+class _StubEngine:
+    def __init__(self, url):
+        self.url = url
+
+    def dispose(self, **kwargs):
+        pass
+
+
+def _stub_admin(monkeypatch, url):
+    itf = PostgreSQLAdminInterface(_StubEngine(url), sqlalchemy.MetaData())
+    calls = []
+
+    def _execute(statement, *args, **kwargs):
+        calls.append(statement)
+        return _StubResult()
+
+    monkeypatch.setattr(itf, 'execute', _execute)
+    return itf, calls
+
+
+def test_wait_until_server_ready_tcp_probe_fails(monkeypatch):
+    # nothing listens on port 1, so the probe is refused
+    url = make_url('postgresql://u@127.0.0.1:1/db')
+    itf, calls = _stub_admin(monkeypatch, url)
+    # a fixed interval, and the default exponential backoff
+    for interval in (.05, None):
+        start = time.monotonic()
+        itf.wait_until_server_ready(timeout=.3, interval=interval)
+        assert .3 <= time.monotonic() - start < 1
+    assert calls == []
+
+
+def test_wait_until_server_ready_unix_socket(monkeypatch):
+    def _probe(*args, **kwargs):
+        raise AssertionError('unexpected tcp probe')
+
+    monkeypatch.setattr(socket, 'create_connection', _probe)
+    urls = [
+        make_url('postgresql://u@/db'),
+        URL.create('postgresql', username='u', host='/tmp', database='db'),
+    ]
+    for url in urls:
+        itf, calls = _stub_admin(monkeypatch, url)
+        itf.wait_until_server_ready(timeout=1)
+        assert len(calls) == 1
+
+
+def test_database_names_cache(monkeypatch):
+    engine = sqlalchemy.create_engine('sqlite://')
+
+    # sqlite has no CREATE DATABASE; record it in pg_database instead
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute', retval=True)
+    def _on_execute(conn, cursor, statement, parameters, context, many):
+        if statement.startswith('CREATE DATABASE '):
+            name = statement.split()[2].rstrip(';')
+            statement = f"INSERT INTO pg_database VALUES ('{name}');"
+        return statement, parameters
+
+    itf = PostgreSQLAdminInterface(engine, sqlalchemy.MetaData())
+    itf.execute(text('CREATE TABLE pg_database (datname TEXT);'))
+    itf.execute(text("INSERT INTO pg_database VALUES ('db1');"))
+    now = [100.]
+    monkeypatch.setattr(
+        interfaces, 'time', types.SimpleNamespace(monotonic=lambda: now[0]))
+    assert itf.exists('db1')
+    itf.execute(text("INSERT INTO pg_database VALUES ('db2');"))
+    # reused within the ttl
+    assert not itf.exists('db2')
+    now[0] += itf._catalog_ttl
+    # refetched once the ttl expires
+    assert itf.exists('db2')
+    itf.create_database('db3')
+    assert itf._database_names is None
+    assert itf.exists('db3')
+
+
+def test_create_tables_checkfirst_and_ignore(tmp_path):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path}/t.db')
+    statements = []
+    sqlalchemy.event.listen(
+        engine, 'before_cursor_execute',
+        lambda conn, cursor, stmt, *args: statements.append(stmt),
+    )
+    itf = SQLInterface(engine, sqlalchemy.MetaData())
+    for name in ('t1', 't2_view'):
+        sqlalchemy.Table(
+            name, itf.metadata, sqlalchemy.Column('x', sqlalchemy.Integer))
+    itf.create_tables(['t1', 't2_view'], checkfirst=False)
+    # no existence check before CREATE TABLE
+    assert [s.split()[:2] for s in statements] == [['CREATE', 'TABLE']]
+    assert sqlalchemy.inspect(engine).get_table_names() == ['t1']